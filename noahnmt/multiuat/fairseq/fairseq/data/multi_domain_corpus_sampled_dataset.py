@@ -8,6 +8,7 @@ from collections import OrderedDict
 from typing import Callable, Dict, List
 import random
 import numpy as np
+import torch
 
 from . import FairseqDataset
 
@@ -87,7 +88,11 @@ class MultidomainCorpusSampledDataset(FairseqDataset):
     def update_sampling_p(self, p):
         logger.info("******* Previous Sampling Probability *******")
         self.get_sample_prob()
-        self.p = p
+        # accept either a torch tensor or a numpy array and convert once;
+        # sampling_func feeds self.p to np.random.choice
+        if torch.is_tensor(p):
+            p = p.numpy()
+        self.p = np.asarray(p)
         logger.info("******* Current Sampling Probability *******")
         self.get_sample_prob()
 
@@ -286,6 +286,8 @@ class MultiUncertainTrainer(object):
         if self.is_data_parallel_master:  # only save one checkpoint
             extra_state["metrics"] = metrics.state_dict()
             extra_state["previous_training_time"] = self.cumulative_training_time()
+            if hasattr(self.task, "state_dict"):
+                extra_state["task_state"] = self.task.state_dict()
             checkpoint_utils.save_state(
                 filename,
                 self.cfg,
@@ -404,6 +406,9 @@ class MultiUncertainTrainer(object):
                 self._previous_training_time = extra_state["previous_training_time"]
                 self._start_time = time.time()
 
+            if "task_state" in extra_state and hasattr(self.task, "load_state_dict"):
+                self.task.load_state_dict(extra_state["task_state"])
+
             self.lr_step(epoch)
 
             if itr_state["version"] >= 2 and itr_state["iterations_in_epoch"] == 0:
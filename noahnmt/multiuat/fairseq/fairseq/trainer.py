@@ -279,6 +279,8 @@ class Trainer(object):
         if self.is_data_parallel_master:  # only save one checkpoint
             extra_state["metrics"] = metrics.state_dict()
             extra_state["previous_training_time"] = self.cumulative_training_time()
+            if hasattr(self.task, "state_dict"):
+                extra_state["task_state"] = self.task.state_dict()
             checkpoint_utils.save_state(
                 filename,
                 self.cfg,
@@ -397,6 +399,9 @@ class Trainer(object):
                 self._previous_training_time = extra_state["previous_training_time"]
                 self._start_time = time.time()
 
+            if "task_state" in extra_state and hasattr(self.task, "load_state_dict"):
+                self.task.load_state_dict(extra_state["task_state"])
+
             self.lr_step(epoch)
 
             if itr_state["version"] >= 2 and itr_state["iterations_in_epoch"] == 0: